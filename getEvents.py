@@ -1,110 +1,83 @@
 import os
 import boto3
 import time
+from boto3.dynamodb.types import TypeSerializer
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from aws_lambda_powertools import Logger
 
 # Configure environment and global vars
 ENV = os.environ.get('ENV')
 DDB_TABLE = os.environ.get('DDB_TABLE')
-TTL = os.environ.get('TTL', 31556926)
+TTL = int(os.environ.get('TTL', 31556926))
+# Max put requests supported by batch-write-item is 25 per query
+BATCH_SIZE = 25
+# Attempts at writing unprocessed items back to DDB before giving up
+BATCH_ATTEMPTS = 5
+# Max concurrent requests to the Health and DDB APIs
+MAX_WORKERS = 16
+
+# Attributes stored for each event, as the attribute name and how to get its value from the event
+ATTR_SPECS = [
+    ('statusCode', lambda event: event.get('statusCode')),
+    ('region', lambda event: event.get('region')),
+    ('service', lambda event: event.get('service')),
+    ('eventDescription', lambda event: event.get('eventDescription')),
+    ('eventTypeCode', lambda event: event.get('eventTypeCode')),
+    ('eventTypeCategory', lambda event: event.get('eventTypeCategory')),
+    ('startTime', lambda event: str(event.get('startTime'))),
+    ('lastUpdatedTime', lambda event: str(event.get('lastUpdatedTime'))),
+    ('eventScopeCode', lambda event: event.get('eventScopeCode')),
+]
 
 
 # Configure logging
 logger = Logger()
 
-# Setup AWS service clients
-health = boto3.client('health')
-ddb = boto3.client('dynamodb')
-
-# Paginate DDB events
-paginator = health.get_paginator('describe_events')
-page_iterator = paginator.paginate(
-    filter={
-        'eventTypeCategories': ['issue']
-    }
+# Setup AWS service clients, with enough pooled connections to sustain concurrent requests
+client_config = Config(
+    max_pool_connections=32,
+    retries={'max_attempts': 5, 'mode': 'adaptive'},
+    tcp_keepalive=True
 )
+health = boto3.client('health', config=client_config)
+ddb = boto3.client('dynamodb', config=client_config)
+serializer = TypeSerializer()
 
 
-def create_ddb_kwargs(event):
-    '''Generate DDB attributes to populate table with'''
+def build_item(event):
+    '''Generate the full DDB item to overwrite an event with'''
 
-    # ea is shorthand for ExpressionAttributes
-    ea_names = {
-        '#reg': 'region'
-    }
-    ea_values = {
-        ':statusCode': {
-            'S': event.get('statusCode'),
-        },
-        ':reg': {
-            'S': event.get('region'),
-        },
-        ':service': {
-            'S': event.get('service'),
-        },
-        ':eventDescription': {
-            'S': event.get('eventDescription'),
-        },
-        ':eventTypeCode': {
-            'S': event.get('eventTypeCode'),
-        },
-        ':eventTypeCategory': {
-            'S': event.get('eventTypeCategory'),
-        },
-        ':startTime': {
-            'S': str(event.get('startTime')),
-        },
-        ':lastUpdatedTime': {
-            'S': str(event.get('lastUpdatedTime')),
-        },
-        ':eventScopeCode': {
-            'S': event.get('eventScopeCode'),
-        },
-    }
-    update_exp = ("SET"
-                  " statusCode= :statusCode,"
-                  " #reg= :reg,"
-                  " service= :service,"
-                  " eventDescription= :eventDescription,"
-                  " eventTypeCode= :eventTypeCode,"
-                  " eventTypeCategory= :eventTypeCategory,"
-                  " startTime= :startTime,"
-                  " lastUpdatedTime= :lastUpdatedTime,"
-                  " eventScopeCode= :eventScopeCode"
-                  )
-
-    if event.get('statusCode') == 'closed':  # Add TTL to remove old status events from DDB
-        ea_names = ea_names | {
-            '#expires': 'ttl'
-        }
-        # Current time plus TTL env var amount as int
-        ttl = int(time.time()) + TTL
-        closed_values = {
-            ':expires': {
-                'N': f'{ttl}',
-            },
-            ':endTime': {
-                'S': f'{event.get("endTime")}',
-            },
-        }
-        ea_values = ea_values | closed_values
-        update_exp += ", #expires = if_not_exists(#expires, :expires), endTime= :endTime"
+    item = {name: serializer.serialize(get_value(event))
+            for name, get_value in ATTR_SPECS}
+    item['PK'] = serializer.serialize('ARN#' + event['arn'])
 
-    return ea_names, ea_values, update_exp
+    # Add TTL to remove old status events from DDB, timed from when closed events ended or open events
+    # were last updated so that rewriting an unchanged event leaves the item untouched and emits no stream record
+    expires_from = event.get('lastUpdatedTime')
+    if event.get('statusCode') == 'closed' and event.get('endTime') != None:
+        item['endTime'] = serializer.serialize(str(event.get('endTime')))
+        expires_from = event.get('endTime')
+    item['ttl'] = serializer.serialize(int(expires_from.timestamp()) + TTL)
+    return item
 
 
 def get_event_details(events):
     '''Drill down into each event to obtain event description'''
 
     event_details = []
+    # Index events by ARN so details can be matched back to their event, which also drops any duplicate
+    # events as DDB rejects a batch write with more than one request for the same item
+    events_by_arn = {event['arn']: event for event in events}
+    arns = list(events_by_arn)
     # Max ARNs supported by describe-event-details is 10 per query
-    for i in range(0, len(events), 10):
-        arn_list = []
-        arn_chunk = events[i:i+10]
+    arn_chunks = [arns[i:i+10] for i in range(0, len(arns), 10)]
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        responses = list(executor.map(
+            lambda arns: health.describe_event_details(eventArns=arns), arn_chunks))
 
-        for event in arn_chunk:  # Get list of ARNs for use as a param in getting event details
-            arn_list.append(event.get('arn'))
-        response = health.describe_event_details(eventArns=arn_list)
+    for response in responses:
         valid_events = response.get('successfulSet')
 
         for event in valid_events:
@@ -113,31 +86,49 @@ def get_event_details(events):
             except KeyError:
                 logger.warn(
                     'latestDescription could not be found for this event.')
-            itx = next(
-                # loop through and assign event details to each event
-                item for item in events if item['arn'] == event['event']['arn'])
+            # Assign event details to each event, once per ARN
+            itx = events_by_arn.pop(event['event']['arn'], None)
+            if itx == None:
+                continue
             itx['eventDescription'] = latest_desc
             event_details.append(itx)
     return event_details
 
 
+def batch_write(chunk):
+    '''Overwrite a chunk of DDB items, retrying any unprocessed items with exponential backoff'''
+
+    request_items = {
+        DDB_TABLE: [{'PutRequest': {'Item': item}} for item in chunk]
+    }
+    for attempt in range(BATCH_ATTEMPTS):
+        response = ddb.batch_write_item(RequestItems=request_items)
+        request_items = response.get('UnprocessedItems')
+        if not request_items:
+            return
+        delay = 0.05 * 2 ** attempt
+        logger.warning(
+            f'{len(request_items[DDB_TABLE])} items were unprocessed. Retrying in {delay} seconds')
+        time.sleep(delay)
+    raise RuntimeError(
+        f'Could not write {len(request_items[DDB_TABLE])} items to DDB after {BATCH_ATTEMPTS} attempts')
+
+
 def update_ddb(full_events):
     '''Update DDB items with retrieved attributes and data'''
 
-    for event in full_events:
-        ea_names, ea_values, update_exp = create_ddb_kwargs(event)
+    # Skip events whose TTL has already passed, as DDB would delete them and they would be
+    # recreated by the next run, posting them to Discord as new events each time
+    now = int(time.time())
+    items = (item for item in map(build_item, full_events)
+             if int(item['ttl']['N']) > now)
 
-        ddb.update_item(
-            TableName=DDB_TABLE,
-            Key={
-                'PK': {
-                    'S': 'ARN#' + event['arn']
-                }
-            },
-            UpdateExpression=update_exp,
-            ExpressionAttributeNames=ea_names,
-            ExpressionAttributeValues=ea_values,
-        )
+    # Events are fully refreshed each run so can be overwritten in batches
+    chunks = iter(lambda: list(islice(items, BATCH_SIZE)), [])
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = [executor.submit(batch_write, chunk) for chunk in chunks]
+    for future in futures:
+        future.result()  # Raise any exception encountered whilst writing
 
 
 def event_iterator():
@@ -147,14 +138,17 @@ def event_iterator():
     page_iterator = paginator.paginate(
         filter={
             'eventTypeCategories': ['issue']
+        },
+        # Max events supported by describe-events is 100 per page
+        PaginationConfig={
+            'PageSize': 100
         }
     )
     event_list = []
     for page in page_iterator:
-        for event in page.get('events'):
-            # Doubly ensure only public, issue type events are added to the DB
-            if ((event.get('eventScopeCode') == 'PUBLIC') and (event.get('eventTypeCategory') == 'issue')):
-                event_list.append(event)
+        # Issue type is filtered by the API, but it has no event scope filter so ensure only public events are added to the DB
+        event_list.extend(
+            event for event in page.get('events') if event.get('eventScopeCode') == 'PUBLIC')
     return event_list
 
 
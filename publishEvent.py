@@ -5,28 +5,48 @@ import time
 import json
 import boto3
 import difflib
+import random
+import zlib
 from aws_lambda_powertools import Logger
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
+from requests.adapters import HTTPAdapter
 
 # Configure logging
 logger = Logger()
 
-# Setup AWS service client
-ddb = boto3.client('dynamodb')
-ssm = boto3.client('ssm')
+# Setup AWS service clients, keeping connections alive and adapting retries to throttling
+client_config = Config(
+    max_pool_connections=32,
+    retries={'max_attempts': 5, 'mode': 'adaptive'},
+    tcp_keepalive=True
+)
+ddb = boto3.client('dynamodb', config=client_config)
+ssm = boto3.client('ssm', config=client_config)
+
+# Keep Discord connections alive across embeds and warm invocations
+session = requests.Session()
+session.mount('https://', HTTPAdapter(
+    pool_connections=4, pool_maxsize=8, max_retries=0))
+# Connect and read timeouts for Discord requests
+TIMEOUT = (3, 10)
+# Attempts at delivering each embed to Discord before giving up
+MAX_ATTEMPTS = 5
 
 # Configure environment and global vars
 ENV = os.environ.get('ENV')
 DDB_TABLE = os.environ.get('DDB_TABLE_NAME')
-# Discord API webhook URL
-URL = ssm.get_parameter(
-    Name=f'/{ENV}/awshealth/URL', WithDecryption=True)['Parameter']['Value']
-# URL for failed events to be sent to
-FAIL_URL = ssm.get_parameter(
-    Name=f'/{ENV}/awshealth/FAIL_URL', WithDecryption=True)['Parameter']['Value']
+# Seconds to cache SSM parameters for across warm invocations
+PARAM_TTL = 900
+# Cached SSM parameter values keyed by name, as a tuple of (expiry time, params)
+ssm_cache = (0, {})
 
 # The ordering of fieldKeys dictates the field ordering in the Discord embed, they are inline
 fieldKeys = ['startTime', 'endTime', 'lastUpdatedTime', 'region']
+# Fields to display as Discord timestamps, either relative or as the full date and time
+timeKeys = {'startTime', 'endTime', 'lastUpdatedTime'}
+relativeTimeKeys = {'lastUpdatedTime'}
 # Colours to help indicate embed event status
 colors = {
     'Issue': 16711680,  # Red - for new issues or reopened
@@ -34,100 +54,134 @@ colors = {
     'Change': 16760576,  # Amber - for ongoing issues that were updated with new info
     'Historical': 38655  # Blue-ish - for closed issues, info is for posterity only
 }
+# DETAILS_TEMPLATE contains each attribute as key, and is copied per record to hold its values.
+#   'Action' refers to which record types the app will post to Discord
+#       when new/updated/removed events occur via DDB.
+#       i.e. region with 'Action' set to:
+#           'PRIVATE' will not display as a delta,
+#           'MODIFY' will show the new/old values for region in the embed body
+#               (separate to fields which are always present).
+#   'FullName' is the actual name to use for the attribute when referencing in a string
+DETAILS_TEMPLATE = {
+    'arn': {
+        'Action': ['PRIVATE'],
+        'FullName': 'Amazon Resource Name'
+    },
+    'eventDescription': {
+        'Action': ['INSERT', 'MODIFY'],
+        'FullName': 'Description'
+    },
+    'region': {
+        'Action': ['INSERT', 'MODIFY'],
+        'FullName': 'Region',
+    },
+    'eventScopeCode': {
+        'Action': ['PRIVATE'],
+        'FullName': 'Event Scope'
+    },
+    'startTime': {
+        'Action': ['PRIVATE'],
+        'FullName': 'Start Time'
+    },
+    'lastUpdatedTime': {
+        'Action': ['PRIVATE'],
+        'FullName': 'Last Updated'
+    },
+    'endTime': {
+        'Action': ['PRIVATE'],
+        'FullName': 'End Time'
+    },
+    'statusCode': {
+        'Action': ['PRIVATE'],
+        'FullName': 'Status Code'
+    },
+    'service': {
+        'Action': ['INSERT', 'MODIFY'],
+        'FullName': 'Service'
+    },
+    'eventTypeCategory': {
+        'Action': ['PRIVATE'],
+        'FullName': 'Event Type Category'
+    },
+    'eventTypeCode': {
+        'Action': ['PRIVATE'],
+        'FullName': 'Event Type'
+    },
+    'publishedAt': {
+        'Action': ['PRIVATE'],
+        'FullName': 'Time Published'
+    },
+    'discordMsgId': {
+        'Action': ['PRIVATE'],
+        'FullName': 'Discord Message ID'
+    },
+}
+
+
+def get_ssm_params(*names):
+    '''Fetches SSM parameters in a single request, caching them for reuse in warm invocations'''
+
+    global ssm_cache
+    expiry, params = ssm_cache
+    if time.time() > expiry or any(name not in params for name in names):
+        response = ssm.get_parameters(Names=list(names), WithDecryption=True)
+        # Parameters that don't exist are cached too, as None, so they aren't fetched on every call
+        params = dict.fromkeys(response['InvalidParameters'])
+        params.update({param['Name']: param['Value']
+                      for param in response['Parameters']})
+        ssm_cache = (time.time() + PARAM_TTL, params)
+    return [params[name] for name in names]
+
+
+def get_urls():
+    '''Gets the Discord webhook URLs from SSM'''
+
+    url, fail_url = get_ssm_params(
+        f'/{ENV}/awshealth/URL', f'/{ENV}/awshealth/FAIL_URL')
+    if url == None:
+        raise ValueError('Discord webhook URL parameter could not be found')
+
+    # Discord API webhook URL(s), comma-separated to spread events across each webhook's rate limit bucket
+    url_list = [u.strip() for u in url.split(',')]
+    # URL for failed events to be sent to, which is optional
+    return url_list, fail_url
 
 
 @logger.inject_lambda_context
 def lambda_handler(event, context):
     '''AWS Lambda event handler'''
 
-    '''details dict contains each attribute as key. 
-        'Action' refers to which record types the app will post to Discord 
-            when new/updated/removed events occur via DDB.
-           i.e. region with 'Action' set to:
-                    'PRIVATE' will not display as a delta,
-                    'MODIFY' will show the new/old values for region in the embed body
-                        (separate to fields which are always present).
-        'FullName' is the actual name to use for the attribute when referencing in a string
-    '''
-    details = {
-        'arn': {
-            'Action': ['PRIVATE'],
-            'FullName': 'Amazon Resource Name'
-        },
-        'eventDescription': {
-            'Action': ['INSERT', 'MODIFY'],
-            'FullName': 'Description'
-        },
-        'region': {
-            'Action': ['INSERT', 'MODIFY'],
-            'FullName': 'Region',
-        },
-        'eventScopeCode': {
-            'Action': ['PRIVATE'],
-            'FullName': 'Event Scope'
-        },
-        'startTime': {
-            'Action': ['PRIVATE'],
-            'FullName': 'Start Time'
-        },
-        'lastUpdatedTime': {
-            'Action': ['PRIVATE'],
-            'FullName': 'Last Updated'
-        },
-        'endTime': {
-            'Action': ['PRIVATE'],
-            'FullName': 'End Time'
-        },
-        'statusCode': {
-            'Action': ['PRIVATE'],
-            'FullName': 'Status Code'
-        },
-        'service': {
-            'Action': ['INSERT', 'MODIFY'],
-            'FullName': 'Service'
-        },
-        'eventTypeCategory': {
-            'Action': ['PRIVATE'],
-            'FullName': 'Event Type Category'
-        },
-        'eventScopeCode': {
-            'Action': ['PRIVATE'],
-            'FullName': 'Event Scope'
-        },
-        'eventTypeCode': {
-            'Action': ['PRIVATE'],
-            'FullName': 'Event Type'
-        },
-        'publishedAt': {
-            'Action': ['PRIVATE'],
-            'FullName': 'Time Published'
-        },
-        'discordMsgId': {
-            'Action': ['PRIVATE'],
-            'FullName': 'Discord Message ID'
-        },
-    }
-
+    _, fail_url = get_urls()
     try:
         # Only have Lambda parse DDB event stream records; we don't care about Remove events
         if('Records' in event):
-            # Should only be 1 event per DDB records batch
+            # Embeds are built for every record in the batch first so they can be sent together
+            event_embeds = []
             for ev in event.get('Records'):
                 logger.debug(f'Event: {ev}')
                 action = ev.get('eventName')
 
                 if action != 'REMOVE':
+                    # Fresh copy of the details for this record, 'Action' lists are read-only so needn't be copied
+                    details = {key: dict(detail)
+                               for key, detail in DETAILS_TEMPLATE.items()}
                     # Pull the new/old values into the dict and calc delta for the event description
                     load_dict_values(
                         ev, action, details)
                     logger.debug(f'Updated Details: {details}')
-                    # Parse data into chunks and then send to Discord webhook
-                    handle_event(ev, details)
+                    # Parse data into chunks ready to send to Discord
+                    embeds = handle_event(ev, details)
+                    if embeds:
+                        event_embeds.append((details['arn']['NewValue'], embeds))
+
+            # Send all the embeds to Discord webhooks
+            publish_to_discord(event_embeds)
 
     except Exception as e:
         logger.exception(f'An error occurred: {e}')
-        if FAIL_URL != None:
-            requests.post(FAIL_URL, json={'body': context.aws_request_id})
+        if fail_url != None:
+            session.post(
+                fail_url, json={'body': context.aws_request_id}, timeout=TIMEOUT)
         raise  # We should probably stop right there, no?
 
 
@@ -135,43 +189,46 @@ def load_dict_values(event, action, details):
     '''Parses the DDB stream event from record and pulls data into the details dict'''
 
     new_data = event['dynamodb']['NewImage']
-    # For every attr with new values in the event that's also in the details dict, append the new value
-    # This part is applicable for both INSERT and MODIFY records (INSERT only has 'New')
-    for attr in new_data:
-        if attr in details:
-            details[attr]['NewValue'] = new_data[attr]['S']
+    # INSERT records only have new data, whereas MODIFY records also have the old data
+    old_data = event['dynamodb'].get('OldImage', {})
+    # For every attr in the details dict pick up its new and old values from the event, where present
+    for key, detail in details.items():
+        new_value = new_data.get(key)
+        if new_value != None:
+            detail['NewValue'] = new_value['S']
+        old_value = old_data.get(key)
+        if old_value != None:
+            detail['OldValue'] = old_value['S']
 
-    # However if this is a MODIFY record we also want to add the old data, appended to the dict too.
     if action == 'MODIFY':
-        old_data = event['dynamodb']['OldImage']
-        for key in old_data:
-            if key in details:
-                details[key]['OldValue'] = old_data[key]['S']
         # If the description has changed, let's run a diff check and generate a delta, then append the delta to the dict
         if old_data.get('eventDescription') != new_data.get('eventDescription'):
-            details['eventDescription']['Delta'] = compare_event_descriptions(
+            delta = compare_event_descriptions(
                 details['eventDescription']['OldValue'], details['eventDescription']['NewValue'])
+            if delta:  # Only blank paragraphs may have changed
+                details['eventDescription']['Delta'] = delta
 
     # For future use if we need to refer back any metadata from Discord and relate to DDB PK
     details['arn']['NewValue'] = event['dynamodb']['Keys']['PK']['S']
 
 
 def compare_event_descriptions(old, new):
-    '''Compare new and old values for description and return a delta by analyzing ndiff'''
+    '''Compare new and old values for description and return a delta by analyzing a unified diff'''
 
     old = old.split('\n\n')
     new = new.split('\n\n')
     logger.debug(f'New description is: {old}')
     logger.debug(f'Old description was: {new}')
 
-    diff_list = difflib.ndiff(old, new)
+    # Without context lines only changed lines are returned, skip the two file header lines
+    diff_list = list(difflib.unified_diff(old, new, n=0, lineterm=''))[2:]
     logger.debug(f'Difflist is: {diff_list}')
 
     delta_list = []
     for diff in diff_list:
-        # If not an unchanged diff line, append to list
-        if not diff.startswith('  '):
-            delta_list.append(diff)
+        # Skip hunk headers and blank paragraphs, then separate the diff code from the line i.e. '+ line'
+        if not diff.startswith('@') and diff[1:].strip():
+            delta_list.append(f'{diff[0]} {diff[1:]}')
             logger.debug(f'Diff is: {diff}')
 
     # Break description delta into chunks as Discord diffs have 1k char limit
@@ -182,13 +239,10 @@ def compare_event_descriptions(old, new):
         delta_chunks = split_message(delta, 990)
 
         for chunk in delta_chunks:
-            # Omit as these are usually junk lines
-            if chunk.startswith('?'):
-                continue
             # Check that chunk doesn't contain the diff code already
-            if not (chunk.startswith('+') or chunk.startswith('-')):
+            if not chunk.startswith(('+', '-')):
                 chunk = f'```diff\n{diff_code} {chunk}\n```'
-            elif chunk != ('+ ' or '- '):  # If chunk is not just changed to an empty delta
+            else:
                 chunk = f'```diff\n{chunk}\n```'
             chunk_list.append(chunk)
 
@@ -206,23 +260,28 @@ def split_message(msg, maxchars):
 
 
 def handle_event(event, details):
-    '''Send data to be constructed into a Discord embed'''
+    '''Send data to be constructed into Discord embeds'''
 
     # Create a list of embeds to be iterated over when pushing to Discord
     embeds = construct_embed(event['eventName'], details)
     logger.debug(f'Embeds: {embeds}')
-
-    # Push embeds to Discord channel
-    send_to_discord(embeds)
-    return True
+    return embeds
 
 
 def construct_embed(action, details):
-    '''Constructs the embed out of the constituent parts required'''
+    '''Constructs the embed out of the constituent parts required, or none if there's nothing to show'''
+
+    parameters = create_embed_content(action, details)
+    # Skip modified events with nothing to show, such as only lastUpdatedTime changing
+    if (action == 'MODIFY'
+            and not parameters
+            and 'Delta' not in details['eventDescription']
+            and details['statusCode'].get('NewValue') == details['statusCode'].get('OldValue')):
+        logger.info('No user-visible delta; skipping Discord post')
+        return []
 
     # Create the various components needed for embeds
     embed_title, embed_color = create_embed_header(action, details)
-    parameters = create_embed_content(action, details)
 
     if 'Delta' in details.get('eventDescription'):
         embed_desc = ['**DESCRIPTION CHANGED:**\n'] + \
@@ -232,44 +291,34 @@ def construct_embed(action, details):
     embed_fields = create_embed_fields(details)
     embed_footer = create_embed_footer()
 
-    # Convert desc_chunks into list of lists with 3 chunks in each
+    # Combine desc chunks into parent chunks of up to 3k chars each, one per embed
     # Desc chunk length is always less than 1k chars per chunk so max of 3 should be fine
     chunk_list = []
-    chunk_data = ''
+    chunk_data = []
     chunk_chars = 0
-    # Loop through all chunks in the embed_desc list and combine into parent chunks of up to 3k chars each
-    for i in range(len(embed_desc)):
-        if chunk_chars <= 3000:  # Chunk still has space for more characters
-            chunk_chars = chunk_chars + len(embed_desc[i])
-            chunk_data = chunk_data + ''.join(embed_desc[i])
-            i += 1
-            logger.debug(f'i: {i}')
-            logger.debug(f'Chunk data: {chunk_data}')
-            logger.debug(f'Total chunk chars: {chunk_chars}')
-        else:  # This chunk is full
-            logger.debug('Chunk size is over 3000 chars')
-            chunk_list.append(chunk_data)
+    for desc in embed_desc:
+        if chunk_data and chunk_chars + len(desc) > 3000:  # This chunk is full, start the next
+            logger.debug('Chunk size would be over 3000 chars')
+            chunk_list.append(''.join(chunk_data))
+            chunk_data = []
             chunk_chars = 0
-            chunk_data = ''
+        chunk_data.append(desc)
+        chunk_chars += len(desc)
+        logger.debug(f'Total chunk chars: {chunk_chars}')
 
-    chunk_list.append(chunk_data)  # Capture partial chunk and add to embed
+    chunk_list.append(''.join(chunk_data))  # Capture partial chunk and add to embed
     logger.debug(f'Final chunk list: {chunk_list}')
 
-    # Merge child description chunks inside the embed chunks so it's in a human-readable output
-    merged_descs = []
-    for chunks in chunk_list:
-        merged_descs.append(''.join(chunks))
-
     # Create Discord embeds
     embed_list = []
-    for desc in merged_descs:
+    for i, desc in enumerate(chunk_list):
         embed = {
             'color': embed_color,
             'description': desc
         }
-        if (desc == merged_descs[0]):  # First desc chunk i.e header
+        if i == 0:  # First desc chunk i.e header
             embed['title'] = embed_title
-        if (desc == merged_descs[-1]):  # Last desc chunk i.e. footer
+        if i == len(chunk_list) - 1:  # Last desc chunk i.e. footer
             embed['fields'] = embed_fields
             embed['footer'] = embed_footer
             embed['timestamp'] = str(datetime.now(timezone.utc))
@@ -350,33 +399,21 @@ def create_embed_fields(details):
 
     # Create fields by looping through the global var and format accordingly
     for key in fieldKeys:
-        try:
-            time = int(datetime.fromisoformat(
-                details[key]['NewValue']).timestamp())
-        except ValueError:  # Field is not able to be coalesced into a datetime object, so create as non-time field
-            time = None
-        except KeyError:  # Key was removed for whatever reason from the event, so skip this field
+        value = details[key].get('NewValue')
+        # Key was removed for whatever reason from the event, or stored without a value, so skip this field
+        if value in (None, 'None'):
             continue
 
-        if time == None:
-            field = {
-                'name': details[key]['FullName'],
-                'value': details[key]['NewValue'],
-                'inline': 'True'
-            }
-        elif key == 'lastUpdatedTime':
-            field = {
-                'name': details[key]['FullName'],
-                'value': f'<t:{time}:R>',
-                'inline': 'True'
-            }
-        else:
-            field = {
-                'name': details[key]['FullName'],
-                'value': f'<t:{time}:F>',
-                'inline': 'True'
-            }
+        if key in timeKeys:
+            timestamp = int(datetime.fromisoformat(value).timestamp())
+            style = 'R' if key in relativeTimeKeys else 'F'
+            value = f'<t:{timestamp}:{style}>'
 
+        field = {
+            'name': details[key]['FullName'],
+            'value': value,
+            'inline': 'True'
+        }
         fieldList.append(field)
     return fieldList
 
@@ -405,12 +442,11 @@ def calculate_discord_delay(r, status):
     limit_scope = headers.get('x-ratelimit-scope')
 
     # Message just sent was fine but we've now hit a limit, so add delay
-    if status == 200 and limit_remaining == 0:
+    if 200 <= status < 300 and limit_remaining == '0':  # Header values are strings
         reset_time = bucket_reset_after
         logger.warning('Discord API reqs rate limit now exhausted!')
-        logger.warning('Rate limit bucket changes in: ' +
-                       reset_time + ' seconds')
-    if status == 429:  # Rate limited
+        logger.warning(f'Rate limit bucket changes in: {reset_time} seconds')
+    elif status == 429:  # Rate limited
         # Get dynamic delay from headers and add slight extra as buffer
         req_retry_after = json.loads(r.text)['retry_after'] + fixed_delay
         # Pick the higher of the two delay values
@@ -423,42 +459,79 @@ def calculate_discord_delay(r, status):
     return reset_time
 
 
-def send_to_discord(embeds):
+def publish_to_discord(event_embeds):
+    '''Sends the (PK, embeds) of each event to Discord, concurrently across webhooks'''
+
+    if not event_embeds:
+        return
+
+    # Every record for an item goes to the same webhook, picked by its PK, so its embeds are displayed in order
+    url_list, _ = get_urls()
+    webhook_queues = {}
+    for pk, embeds in event_embeds:
+        url = url_list[zlib.crc32(pk.encode()) % len(url_list)]
+        webhook_queues.setdefault(url, []).append(embeds)
+
+    # Each webhook sends its events serially as they share a rate limit bucket
+    with ThreadPoolExecutor(max_workers=len(webhook_queues)) as executor:
+        futures = [executor.submit(send_events, url, queue)
+                   for url, queue in webhook_queues.items()]
+    for future in futures:
+        future.result()  # Raise any exception encountered whilst sending
+
+
+def send_events(url, queue):
+    '''Passes the embeds of each event in turn to a Discord webhook'''
+
+    for embeds in queue:
+        send_to_discord(url, embeds)
+
+
+def send_to_discord(url, embeds):
     '''Passes the embed(s) to Discord'''
     logger.debug(f'EMBEDS: {embeds}')
     if bool(embeds) == False:
         raise TypeError('Embeds is empty. At least one embed must be given.')
-    else:
-        delay = 0.25
-        for embed in embeds:
-            logger.debug(f'EMBED IS: {embed}')
-            status = None
-            body = {
-                "embeds": [embed]
-            }
-            while status != 200:  # Message not successfully delivered to Discord
-                if status != None:
-                    logger.warning(
-                        f'Status was {status}. Delaying next request by {delay} seconds')
-                time.sleep(delay)
-                try:
-                    r = requests.post(URL, json=body)
-                    status = r.status_code
-                    logger.info(f'Discord response status: {status}')
-                except:
+
+    for embed in embeds:
+        logger.debug(f'EMBED IS: {embed}')
+        body = {
+            "embeds": [embed]
+        }
+        for attempt in range(MAX_ATTEMPTS):
+            try:
+                r = session.post(url, json=body, timeout=TIMEOUT)
+            except requests.RequestException as e:
+                logger.warning(
+                    f'An error occurred sending the payload to Discord: {e}')
+                status = None
+            else:
+                status = r.status_code
+                logger.info(f'Discord response status: {status}')
+                if 200 <= status < 300:  # Message success, add metadata back to DDB
+                    logger.info('Payload successfully delivered to Discord')
+                    logger.debug(f'Payload: {body}')
+                    # Wait for the rate limit bucket to reset before the next post if it's now exhausted
+                    if r.headers.get('x-ratelimit-remaining') == '0':
+                        time.sleep(calculate_discord_delay(r, status))
+                    break
+                if status != 429 and status < 500:  # i.e. deleted webhook or rejected embed, retrying won't help
                     logger.critical(
-                        'An error occurred sending the payload to Discord')
-                    logger.critical(f'Response: {r.content}')
-                    logger.critical(f'Payload:' + {body})
-                    logger.critical(f'Delay: ' + {delay})
-                else:
-                    if status == 200:  # Message success, add metadata back to DDB
-                        logger.info(
-                            'Payload successfully delivered to Discord')
-                        logger.debug(f'Payload:' + {body})
-                    else:  # Something happened other than success, log and recalculate delay in case of rate limit
-                        logger.critical(f'Status was {status}')
-                        logger.critical(f'Embeds: {embeds}')
-                        logger.critical(f'Payload: {body}')
-                        delay = calculate_discord_delay(r, status)
-                    return True
+                        f'Payload was rejected by Discord with status {status}: {r.text}')
+                    logger.critical(f'Payload: {body}')
+                    break
+
+            if attempt == MAX_ATTEMPTS - 1:  # Message not successfully delivered to Discord
+                logger.critical(f'Payload: {body}')
+                raise RuntimeError(
+                    f'Could not deliver embed to Discord after {MAX_ATTEMPTS} attempts')
+
+            # Rate limited or a transient error, wait for the rate limit if that's the cause or back off
+            if status == 429:
+                delay = calculate_discord_delay(r, status)
+            else:
+                delay = 0.25 * 2 ** attempt + random.uniform(0, 0.25)
+            logger.warning(
+                f'Status was {status}. Delaying next request by {delay} seconds')
+            time.sleep(delay)
+    return True